@@ -1,9 +1,10 @@
-import uvicorn
 import multiprocessing
 
-from . import app, settings
-
 if __name__ == "__main__":
     multiprocessing.freeze_support()
 
+    import uvicorn
+
+    from . import app, settings
+
     uvicorn.run(app, host=settings.API_HOST, port=settings.API_PORT)
@@ -3,31 +3,59 @@ from typing import Optional
 import multiprocessing
 
 import fastapi
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
 from fastapi.responses import FileResponse, StreamingResponse
+from pydantic import TypeAdapter
 import datetime
 
 import zipfile
 
 from ..abc import *
-from ..content import ContentList, ContentManager
+from ..content import Content, ContentList, ContentManager
+from ..settings import settings
+from .limit import *
 
 __all__ = [
     "api"
     "contents"
 ]
 
-api = APIRouter()
+rate_limiter = RateLimiter(settings.RATE_LIMIT, settings.RATE_BURST)
+zip_limiter = DownloadLimiter(settings.ZIP_CONCURRENCY, settings.ZIP_QUEUE)
+thumbnail_flight = SingleFlight()
+thumbnail_cache = SizedCache(settings.THUMBNAIL_CACHE)
+
+api = APIRouter(dependencies=[Depends(rate_limiter)])
 
 content_manager = ContentManager()
 
+contents_adapter = TypeAdapter(list[Content])
+contents_cache = {} # platform -> (generation, json)
+
+def read_thumbnail(path, name, last_modified):
+    key = (path, name, last_modified)
+    data = thumbnail_cache.get(key)
+    if data is None:
+        with zipfile.ZipFile(path) as zf:
+            with zf.open(name) as f:
+                data = f.read()
+        thumbnail_cache.put(key, data)
+    return data
+
 @api.get("/contents")
 async def get_contents(platform: Optional[Platform] = None, contents: ContentList = Depends(content_manager.on_fastapi_depends)):
     """
     (platformが指定されればそのプラットフォームに対応する)すべてのコンテンツのメタデータを返す
     """
     with contents.use() as c:
-        return [csrc.content for csrc in c if platform is None or len(csrc.content.supported_platforms) == 0 or platform in csrc.content.supported_platforms]
+        # the list only changes with the generation, so serialize it once per generation
+        cached = contents_cache.get(platform, None)
+        if cached is None or cached[0] != c.generation:
+            data = contents_adapter.dump_json([csrc.content for csrc in c if platform is None or len(csrc.content.supported_platforms) == 0 or platform in csrc.content.supported_platforms])
+            cached = (c.generation, data)
+            contents_cache[platform] = cached
+
+    return Response(content=cached[1], media_type="application/json")
 
 @api.get("/content/{content_id}")
 async def get_content_meta(content_id: str, contents: ContentList = Depends(content_manager.on_fastapi_depends)):
@@ -55,7 +83,12 @@ async def get_content_zip(content_id: str, contents: ContentList = Depends(conte
         if src is None:
             raise HTTPException(status_code=404, detail="content not found")
 
-    return FileResponse(src.path, media_type="application/zip")
+    await zip_limiter.acquire()
+    try:
+        return LimitedFileResponse(src.path, media_type="application/zip", limiter=zip_limiter)
+    except:
+        zip_limiter.release()
+        raise
 
 @api.get("/content/{content_id}/thumbnail", response_class=StreamingResponse)
 async def get_content_thumbnail(content_id: str, contents: ContentList = Depends(content_manager.on_fastapi_depends)):
@@ -75,14 +108,14 @@ async def get_content_thumbnail(content_id: str, contents: ContentList = Depends
         if not src.content.thumbnail:
             raise HTTPException(status_code=404, detail="no thumbnail")
 
-        try:
-            with zipfile.ZipFile(src.path) as zf:
-                with zf.open(src.content.thumbnail) as f:
-                    data = f.read()
-        except KeyError:
-            raise HTTPException(status_code=404, detail="no thumbnail")
-        except:
-            raise HTTPException(status_code=500)
+    # concurrent requests for the same thumbnail share one read
+    key = (src.path, src.content.thumbnail, src.content.last_modified)
+    try:
+        data = await thumbnail_flight.do(key, read_thumbnail, *key)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="no thumbnail")
+    except:
+        raise HTTPException(status_code=500)
 
     async def iterdata():
         yield data
@@ -90,10 +123,14 @@ async def get_content_thumbnail(content_id: str, contents: ContentList = Depends
     return StreamingResponse(iterdata(), media_type="image/*")
 
 @api.get("/updates")
-async def updates(since: datetime.datetime, platform: Optional[Platform] = None, contents: ContentList = Depends(content_manager.on_fastapi_depends)):
+async def updates(since: datetime.datetime, response: Response, platform: Optional[Platform] = None, contents: ContentList = Depends(content_manager.on_fastapi_depends)):
     """
     since以降に更新/削除されたコンテンツを返す
+    Retry-After は次にポーリングするまでの秒数の目安
     """
+    if settings.UPDATES_RETRY_AFTER > 0:
+        response.headers["Retry-After"] = retry_after(settings.UPDATES_RETRY_AFTER)
+
     since = since.replace(tzinfo=datetime.timezone.utc)
     with contents.use() as c:
         return {
@@ -0,0 +1,157 @@
+import asyncio
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse
+
+__all__ = [
+    "retry_after",
+    "SingleFlight",
+    "RateLimiter",
+    "DownloadLimiter",
+    "LimitedFileResponse",
+    "SizedCache"
+]
+
+def retry_after(seconds: float, jitter: float = 0.5) -> str:
+    # spread clients out so that they do not come back at the same instant
+    seconds = random.uniform(seconds * (1 - jitter), seconds * (1 + jitter))
+    return str(max(1, math.ceil(seconds)))
+
+class SingleFlight:
+    """
+    同じキーに対する同時の呼び出しを1回の計算にまとめる
+    """
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, func, *args):
+        future = self.calls.get(key, None)
+        if future is None:
+            future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+            self.calls[key] = future
+
+            def done(f):
+                if self.calls.get(key, None) is f:
+                    self.calls.pop(key, None)
+
+            future.add_done_callback(done)
+
+        # a cancelled waiter must not cancel the shared call
+        return await asyncio.shield(future)
+
+class RateLimiter:
+    """
+    クライアント(IPアドレス)ごとのトークンバケット
+    """
+    def __init__(self, rate: float, burst: int, *, max_clients: int = 4096):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = {} # host -> (tokens, last)
+
+    async def __call__(self, request: Request):
+        if self.rate <= 0:
+            return
+
+        host = request.client.host if request.client is not None else ""
+        now = time.monotonic()
+
+        tokens, last = self.buckets.get(host, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+        if tokens < 1:
+            self.buckets[host] = (tokens, now)
+            raise HTTPException(status_code=429, headers={"Retry-After": retry_after((1 - tokens) / self.rate)})
+
+        self.buckets[host] = (tokens - 1, now)
+
+        if len(self.buckets) > self.max_clients:
+            self.prune(now)
+
+    def prune(self, now):
+        # forget clients whose bucket has refilled anyway
+        for host, (tokens, last) in list(self.buckets.items()):
+            if tokens + (now - last) * self.rate >= self.burst:
+                self.buckets.pop(host, None)
+
+class DownloadLimiter:
+    """
+    同時にダウンロードできるzipの数を制限し、超えた分は待たせる
+    """
+    def __init__(self, concurrency: int, queue: int, *, retry: float = 5.0):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.retry = retry
+        self.semaphore = asyncio.Semaphore(max(concurrency, 1))
+        self.waiting = 0
+
+    async def acquire(self):
+        if self.concurrency <= 0:
+            return
+
+        # queue 0 lets every request wait
+        if self.queue > 0 and self.semaphore.locked() and self.waiting >= self.queue:
+            raise HTTPException(status_code=503, detail="too many downloads", headers={"Retry-After": retry_after(self.retry)})
+
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        if self.concurrency <= 0:
+            return
+
+        self.semaphore.release()
+
+class LimitedFileResponse(FileResponse):
+    def __init__(self, *args, limiter: DownloadLimiter, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        # release even when the client disconnects halfway
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.limiter.release()
+
+class SizedCache:
+    """
+    合計バイト数で上限を決めるLRUキャッシュ
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.items.get(key, None)
+            if data is not None:
+                self.items.move_to_end(key)
+            return data
+
+    def put(self, key, data: bytes):
+        if len(data) > self.max_bytes:
+            # would evict everything else
+            return
+
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            self.items[key] = data
+            self.size += len(data)
+
+            while self.size > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
@@ -0,0 +1,136 @@
+import os
+import asyncio
+import dataclasses
+import time
+from typing import Callable, Optional
+
+from .content import ContentManager, CONTENT_FILENAME, STATE_FILENAMES, load_downloading
+
+__all__ = [
+    "CollectResult",
+    "ContentsCollector"
+]
+
+@dataclasses.dataclass
+class CollectResult:
+    removed: list[str]
+    reclaimed: int # bytes
+    total: int # bytes left in contents_dir
+
+class ContentsCollector:
+    def __init__(self, contents_dir: str, content_manager: ContentManager, *, quota: int = 0, grace: float = 60.0, ready: Optional[Callable[[], bool]] = None):
+        self.contents_dir = contents_dir
+        self.content_manager = content_manager
+        # whether the process filling the content list is up and has reported ready
+        self.ready = ready
+        self.quota = quota
+        self.grace = grace
+
+        # path -> (size, mtime) of files seen unreferenced on the previous pass
+        self.marked = {}
+
+    def live_paths(self) -> set[str]:
+        # receive pending contents first so that freshly published zips are not swept
+        if self.content_manager.conn is not None:
+            self.content_manager.content_sync()
+
+        with self.content_manager.content_list.use() as c:
+            return {os.path.normpath(csrc.path) for csrc in c if csrc.path is not None}
+
+    def collect(self) -> CollectResult:
+        live = self.live_paths()
+
+        entries = []
+        total = 0
+        for entry in os.scandir(self.contents_dir):
+            if not entry.is_file() or entry.name in STATE_FILENAMES:
+                continue
+
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            total += st.st_size
+            entries.append((os.path.normpath(entry.path), entry.name, st))
+
+        # the content list is only complete once its producer is ready.
+        # an empty list next to published zips means it never got filled (e.g. the observer died)
+        if self.ready is not None and not self.ready():
+            reason = "producer is not ready"
+        elif len(live) == 0 and any(CONTENT_FILENAME.match(name) for _, name, _ in entries):
+            reason = "content list is empty"
+        else:
+            reason = None
+
+        if reason is not None:
+            print("skip collecting:", reason)
+            # start marking over once the list can be trusted again
+            self.marked = {}
+            return CollectResult(removed=[], reclaimed=0, total=total)
+
+        # partial downloads the mirror will resume
+        downloading = load_downloading(self.contents_dir)
+
+        marked = {}
+        garbage = []
+        evictable = []
+
+        # mark
+        for path, name, st in entries:
+            if path in live:
+                continue
+
+            if name.endswith(".part") and name.split(".", 1)[0] in downloading:
+                continue
+
+            key = (st.st_size, st.st_mtime)
+            marked[path] = key
+
+            if self.marked.get(path, None) == key:
+                # unreferenced and unchanged since the previous pass
+                garbage.append((path, st))
+            elif st.st_mtime < time.time() - self.grace:
+                evictable.append((path, st))
+
+        # enforce quota, least recently used first
+        if self.quota > 0:
+            over = total - sum(st.st_size for _, st in garbage) - self.quota
+            for path, st in sorted(evictable, key=lambda e: max(e[1].st_atime, e[1].st_mtime)):
+                if over <= 0:
+                    break
+                garbage.append((path, st))
+                over -= st.st_size
+
+            if over > 0:
+                print("contents dir is over quota by", over, "bytes which cannot be collected")
+
+        # sweep
+        removed = []
+        reclaimed = 0
+        for path, st in garbage:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            marked.pop(path, None)
+            removed.append(path)
+            reclaimed += st.st_size
+
+        self.marked = marked
+
+        return CollectResult(removed=removed, reclaimed=reclaimed, total=total - reclaimed)
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                result = await asyncio.to_thread(self.collect)
+            except Exception as e:
+                print(e)
+                continue
+
+            for path in result.removed:
+                print("collected", path)
+            if result.removed:
+                print("reclaimed", result.reclaimed, "bytes,", result.total, "bytes in use")
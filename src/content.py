@@ -1,8 +1,12 @@
+import os
+import json
 import datetime
+import re
 
 import dataclasses
 from pydantic import BaseModel
 
+import threading
 from multiprocessing import Lock
 
 from typing import Optional, Union
@@ -16,6 +20,25 @@ __all__ = [
     "ContentList"
 ]
 
+# published zips in contents dir are named after the content id
+CONTENT_FILENAME = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.zip$")
+
+# state of the mirror, see mirror.py
+MIRROR_STATE_FILENAME = ".mirror.json"
+
+# files in contents dir which are not contents
+STATE_FILENAMES = (".uuids.json", ".uuids.json.backup", MIRROR_STATE_FILENAME)
+
+def load_downloading(contents_dir: str) -> set[str]:
+    """
+    ダウンロード途中のコンテンツのidを返す(.partファイルを消さないため)
+    """
+    try:
+        with open(os.path.join(contents_dir, MIRROR_STATE_FILENAME), mode="rb") as f:
+            return set(json.load(f).get("downloading", []))
+    except (OSError, ValueError, AttributeError):
+        return set()
+
 class Content(BaseModel):
     id: str
     author: Optional[str] = None
@@ -55,6 +78,8 @@ class ContentList:
         else:
             self.contents = []
         self.removed = []
+        # bumped on every change so that responses can be reused until then
+        self.generation = 0
 
     def use(self):
         return ContentListSafe(target=self)
@@ -80,12 +105,21 @@ class ContentListSafe:
 
         return self.target.removed
 
+    @property
+    def generation(self):
+        if not self.locked:
+            raise RuntimeError("only use after locked")
+
+        return self.target.generation
+
     def handle_content(self, src: ContentSource) -> list[str]:
         paths = []
 
         if not self.locked:
             raise RuntimeError("only use after locked")
 
+        self.target.generation += 1
+
         if src.content is not None:
             total = len(self.target.contents)
             completed = False
@@ -171,6 +205,7 @@ class ContentManager:
     def __init__(self, conn = None):
         self.content_list = ContentList()
         self.conn = conn
+        self.sync_lock = threading.Lock()
 
     def set_connection(self, conn):
         if self.conn is not None:
@@ -187,13 +222,29 @@ class ContentManager:
         return self.content_list
 
     def content_sync(self):
+        conn = self.conn
+        if conn is None:
+            return
+
         try:
-            with self.content_list.use() as c:
-                while self.conn.poll(0):
-                    csrc = self.conn.recv()
-                    for path in c.handle_content(csrc):
-                        self.conn.send(path)
-                print(c)
-        except EOFError:
+            # nothing to receive, which is the case for almost every request
+            if not conn.poll(0):
+                return
+
+            # while one request syncs, the others wait for it instead of syncing again
+            if not self.sync_lock.acquire(blocking=False):
+                with self.sync_lock:
+                    return
+
+            try:
+                with self.content_list.use() as c:
+                    while conn.poll(0):
+                        csrc = conn.recv()
+                        for path in c.handle_content(csrc):
+                            conn.send(path)
+                    print(c)
+            finally:
+                self.sync_lock.release()
+        except (EOFError, OSError):
             # connection closed
             self.conn = None
\ No newline at end of file
@@ -0,0 +1,383 @@
+import os
+
+import json
+import datetime
+import time
+import urllib.parse
+import urllib.request
+from urllib.error import HTTPError
+from zipfile import ZipFile
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from multiprocessing import Pipe, Lock
+from typing import Optional
+
+from .content import Content, ContentSource, MIRROR_STATE_FILENAME
+
+__all__ = [
+    "ContentsMirror"
+]
+
+class DownloadAborted(Exception):
+    pass
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # only the delay-seconds form is used by this server
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class ContentsMirror:
+    """
+    上流サーバーの /updates を購読し、コンテンツのzipを contents_dir に複製する
+    """
+    def __init__(self, contents_dir: str, conn: Pipe, upstream: str, *, max_workers: int = 2, resync_interval: float = 600.0, timeout: float = 30.0, download_backoff: float = 5.0, max_backoff: float = 60.0):
+        self.contents_dir = contents_dir
+        self.conn = conn
+        self.upstream = upstream.rstrip("/")
+        self.lock = Lock()
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = set()
+
+        self.resync_interval = resync_interval
+        self.timeout = timeout
+        self.download_backoff = download_backoff
+        self.max_backoff = max_backoff
+
+        self.retry_after = None # seconds upstream asked us to wait before the next poll
+        self.failures = 0
+
+        self.since = None
+        self.next_resync = 0.0
+
+        self.wanted = {} # id -> Content on upstream
+        self.local = {} # id -> Content of the zip on disk
+        self.published = {} # id -> last_modified sent to fastapi
+        self.removed = set() # ids upstream reported as removed, to unpublish
+        self.pending = set() # ids being downloaded
+        self.downloading = set() # ids wanted but not on disk yet, their .part files are kept
+        self.download_failures = {} # id -> (last_modified, count, monotonic time to retry at)
+
+        self._shutdown = threading.Event()
+
+        self.load_state()
+
+    def content_path(self, content_id):
+        return os.path.normpath(os.path.join(self.contents_dir, f"{content_id}.zip"))
+
+    def load_state(self):
+        state_path = os.path.join(self.contents_dir, MIRROR_STATE_FILENAME)
+
+        try:
+            with open(state_path, mode="rb") as f:
+                state = json.load(f)
+            contents = {content_id: Content.parse_obj(c) for content_id, c in state.get("contents", {}).items()}
+            downloading = set(state.get("downloading", []))
+        except FileNotFoundError:
+            contents = {}
+            downloading = set()
+        except Exception as e:
+            print("cannot load mirror state:", e)
+            contents = {}
+            downloading = set()
+
+        # forget zips which no longer exist
+        self.local = {
+            content_id: content for content_id, content in contents.items()
+            if os.path.exists(self.content_path(content_id))
+        }
+        self.downloading = downloading
+
+    def save_state(self):
+        state_path = os.path.join(self.contents_dir, MIRROR_STATE_FILENAME)
+        state_tmp_path = os.path.join(self.contents_dir, MIRROR_STATE_FILENAME + ".tmp")
+
+        state = {
+            "contents": {content_id: content.model_dump(mode="json") for content_id, content in self.local.items()},
+            "downloading": sorted(self.downloading)
+        }
+
+        try:
+            with open(state_tmp_path, mode="w") as f:
+                json.dump(state, f, indent=2)
+            os.replace(state_tmp_path, state_path)
+        except OSError as e:
+            print("cannot save mirror state:", e)
+
+    def publish_local(self):
+        # serve what is on disk before upstream answers, it may be unreachable
+        with self.lock:
+            for content in self.local.values():
+                self.publish(content)
+
+    def is_local(self, content):
+        local = self.local.get(content.id, None)
+        return local is not None and local.last_modified == content.last_modified
+
+    def fetch(self, path, **params):
+        url = self.upstream + path
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+
+        with urllib.request.urlopen(url, timeout=self.timeout) as res:
+            self.retry_after = parse_retry_after(res.headers.get("Retry-After", None))
+            return json.load(res)
+
+    def resync(self):
+        # full listing catches anything /updates missed.
+        # it is only complete once upstream is ready, a restarting upstream lists nothing yet
+        try:
+            self.fetch("/readyz")
+        except HTTPError as e:
+            if e.code != 503:
+                raise
+            print("upstream is not ready, skip resync")
+            return
+
+        contents = [Content.parse_obj(c) for c in self.fetch("/contents")]
+        self.next_resync = time.monotonic() + self.resync_interval
+
+        if len(contents) == 0 and (self.local or self.published):
+            # removals come through /updates, never drop local copies for an empty listing
+            print("upstream lists no contents, skip resync")
+            return
+
+        self.wanted = {content.id: content for content in contents}
+        with self.lock:
+            self.removed.update(content_id for content_id in self.published.keys() if content_id not in self.wanted)
+
+    def fetch_updates(self):
+        params = {}
+        if self.since is not None:
+            params["since"] = self.since.isoformat()
+        else:
+            params["since"] = datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc).isoformat()
+
+        result = self.fetch("/updates", **params)
+
+        for c in result["updated"]:
+            content = Content.parse_obj(c)
+            self.wanted[content.id] = content
+            self.advance(content.last_modified)
+
+        for r in result["removed"]:
+            self.wanted.pop(r["id"], None)
+            with self.lock:
+                self.removed.add(r["id"])
+            self.advance(datetime.datetime.fromisoformat(r["last_modified"]))
+
+    def advance(self, last_modified):
+        last_modified = last_modified.astimezone(datetime.timezone.utc)
+        if self.since is None or self.since < last_modified:
+            self.since = last_modified
+
+    def poll(self) -> bool:
+        self.retry_after = None
+        try:
+            if time.monotonic() >= self.next_resync:
+                self.resync()
+            self.fetch_updates()
+        except HTTPError as e:
+            # 429 and 503 tell us when to come back
+            print("upstream", e)
+            self.retry_after = parse_retry_after(e.headers.get("Retry-After", None))
+            self.failures += 1
+            return False
+        except Exception as e:
+            print("upstream", e)
+            self.failures += 1
+            return False
+
+        self.failures = 0
+        self.reconcile()
+        return True
+
+    def next_interval(self, interval: float) -> float:
+        # back off exponentially while upstream keeps failing
+        if self.failures > 0:
+            interval = min(interval * 2 ** self.failures, self.max_backoff)
+        # Retry-After may only push the next poll back, never bring it forward
+        if self.retry_after is not None:
+            interval = max(interval, self.retry_after)
+        return interval
+
+    def reconcile(self):
+        with self.lock:
+            downloading = set()
+            for content_id, content in self.wanted.items():
+                last_modified = content.last_modified.isoformat()
+                if self.is_local(content):
+                    if self.published.get(content_id, None) != last_modified:
+                        self.publish(content)
+                    continue
+
+                downloading.add(content_id)
+                if self.backing_off(content):
+                    continue
+                if content_id not in self.pending and not self._shutdown.is_set():
+                    self.pending.add(content_id)
+                    future = self.executor.submit(self.download, content)
+                    self.futures.add(future)
+                    future.add_done_callback(self.futures.discard)
+
+            # only what upstream said is gone, a copy missing from wanted may just not be listed yet
+            for content_id in self.removed:
+                if content_id not in self.wanted and content_id in self.published:
+                    self.unpublish(content_id)
+            self.removed.clear()
+
+            for content_id in list(self.download_failures.keys()):
+                if content_id not in downloading:
+                    self.download_failures.pop(content_id, None)
+
+            if downloading != self.downloading:
+                self.downloading = downloading
+                self.save_state()
+
+        self.recv()
+
+    def backing_off(self, content) -> bool:
+        # a new version upstream is tried right away
+        failure = self.download_failures.get(content.id, None)
+        return failure is not None and failure[0] == content.last_modified and time.monotonic() < failure[2]
+
+    def download_failed(self, content):
+        # do not fetch a broken zip in full on every poll
+        last_modified, count, _ = self.download_failures.get(content.id, (None, 0, 0.0))
+        if last_modified != content.last_modified:
+            count = 0
+        count += 1
+        delay = min(self.download_backoff * 2 ** (count - 1), self.max_backoff)
+        self.download_failures[content.id] = (content.last_modified, count, time.monotonic() + delay)
+        print("retry", content.id, "in", delay, "seconds")
+
+    def publish(self, content):
+        path = self.content_path(content.id)
+        self.conn.send(ContentSource(path=path, orig_path=path, content=content))
+        self.published[content.id] = content.last_modified.isoformat()
+
+    def unpublish(self, content_id):
+        # fastapi replies with the path to delete
+        self.conn.send(ContentSource(path=None, orig_path=self.content_path(content_id), content=None))
+        self.published.pop(content_id, None)
+        self.local.pop(content_id, None)
+        self.save_state()
+
+    def recv(self):
+        with self.lock:
+            try:
+                while self.conn.poll(0):
+                    path = self.conn.recv()
+                    try:
+                        os.remove(path)
+                    except:
+                        pass
+            except (EOFError, OSError):
+                # connection closed
+                pass
+
+    def download(self, content):
+        final_path = self.content_path(content.id)
+        # one partial file per version so that a resume never mixes two versions
+        part_path = f"{final_path}.{int(content.last_modified.timestamp())}.part"
+
+        try:
+            self.download_to(f"/content/{content.id}/zip", part_path)
+
+            with ZipFile(part_path) as zf:
+                zf.getinfo("manifest.json")
+                if zf.testzip() is not None:
+                    raise ValueError("corrupted zip")
+
+            os.replace(part_path, final_path)
+        except DownloadAborted:
+            # keep the partial file to resume on next start
+            return
+        except Exception as e:
+            print("download", content.id, e)
+            if not isinstance(e, OSError):
+                # the partial file itself is broken, start over next time
+                try:
+                    os.remove(part_path)
+                except OSError:
+                    pass
+            with self.lock:
+                self.pending.discard(content.id)
+                self.download_failed(content)
+            return
+
+        with self.lock:
+            self.pending.discard(content.id)
+            self.downloading.discard(content.id)
+            self.download_failures.pop(content.id, None)
+            self.local[content.id] = content
+            self.save_state()
+            # publish right away unless upstream has moved on meanwhile
+            wanted = self.wanted.get(content.id, None)
+            if wanted is not None and wanted.last_modified == content.last_modified:
+                self.publish(content)
+
+        print("mirrored", content.id)
+
+    def download_to(self, path, part_path):
+        try:
+            offset = os.path.getsize(part_path)
+        except OSError:
+            offset = 0
+
+        req = urllib.request.Request(self.upstream + path)
+        if offset > 0:
+            req.add_header("Range", f"bytes={offset}-")
+
+        try:
+            res = urllib.request.urlopen(req, timeout=self.timeout)
+        except HTTPError as e:
+            if e.code != 416:
+                raise
+            # already complete
+            return
+
+        with res:
+            if res.status != 206:
+                # server ignored the range
+                offset = 0
+
+            length = res.headers.get("Content-Length", None)
+            expected = offset + int(length) if length is not None else None
+
+            with open(part_path, mode="ab" if offset > 0 else "wb") as f:
+                while chunk := res.read(1 << 16):
+                    if self._shutdown.is_set():
+                        raise DownloadAborted()
+                    f.write(chunk)
+
+        if expected is not None and os.path.getsize(part_path) != expected:
+            raise OSError("incomplete download")
+
+    def run(self, interval: float, ready = None):
+        self.publish_local()
+        # ready once the local copies are served, even if upstream is unreachable
+        if ready is not None:
+            ready.set()
+
+        while not self._shutdown.is_set():
+            self.poll()
+            self._shutdown.wait(self.next_interval(interval))
+
+    def stop(self):
+        self._shutdown.set()
+
+    def shutdown(self, timeout: Optional[float] = None) -> list[str]:
+        self._shutdown.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+        # running downloads stop at the next chunk
+        wait(list(self.futures), timeout=timeout)
+
+        self.recv()
+        with self.lock:
+            self.save_state()
+            return sorted(self.pending)
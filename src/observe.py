@@ -9,16 +9,42 @@ import uuid
 from zipfile import ZipFile
 
 import threading
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait
 from multiprocessing import Pipe, Lock, Event
+from typing import Optional
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEvent, FileSystemEventHandler, RegexMatchingEventHandler
 
 from .abc import *
-from .content import Content, ContentSource, ContentList
+from .content import Content, ContentSource, ContentList, CONTENT_FILENAME, STATE_FILENAMES
 from .settings import settings
 
+
+def recover_contents_dir(contents_dir: str) -> list[str]:
+    # remove files left half-written by an interrupted run.
+    # published zips are only ever created by a rename, so anything else is a leftover
+    removed = []
+    for entry in os.scandir(contents_dir):
+        if not entry.is_file() or entry.name in STATE_FILENAMES:
+            continue
+
+        if CONTENT_FILENAME.match(entry.name):
+            try:
+                with ZipFile(entry.path) as zf:
+                    zf.getinfo("manifest.json")
+                continue
+            except Exception:
+                pass
+
+        try:
+            os.remove(entry.path)
+            removed.append(entry.path)
+        except OSError:
+            pass
+
+    return removed
+
 class FileSystemNothingEvent(FileSystemEvent):
     event_type = "nothing"
     def __init__(self):
@@ -41,11 +67,11 @@ class CustomObserver(Observer):
         self.thread = threading.Thread(target=self.start_interval)
         self.thread.start()
 
-    def on_thread_end(self):
+    def on_thread_stop(self):
         if self.thread is not None:
             self.kill_interval.set()
             self.thread.join(10)
-        super().on_thread_end()
+        super().on_thread_stop()
 
 class ContentsHandler(RegexMatchingEventHandler):
     def __init__(self, contents_dir: str, conn: Pipe, *, max_workers : int = 2):
@@ -56,21 +82,59 @@ class ContentsHandler(RegexMatchingEventHandler):
         self.lock = Lock()
 
         self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = set()
         self.processing = {}
 
         self.uuids = None
 
         self._sleep_dur = 0.0
-        self._shutdown = False
+        self._shutdown = False # no new events are accepted
+        self._abandon = False # queued work is dropped
 
     def set_delay(self, duration: float = 0.0):
         self._sleep_dur = duration
 
-    def shutdown(self):
+    def submit(self, fn, *args):
+        if self._shutdown:
+            return None
+
+        try:
+            future = self.executor.submit(fn, *args)
+        except RuntimeError:
+            # executor already shut down
+            return None
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+        return future
+
+    def shutdown(self, timeout: Optional[float] = None) -> list[str]:
+        # stop accepting new events, but let queued and debouncing work finish
         self._shutdown = True
-        self.executor.shutdown()
+        wait(list(self.futures), timeout=timeout)
 
-    def get_uuid(self, name):
+        # past the deadline, drop whatever is left
+        self._abandon = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+        # anything left here was never published.
+        # report it first, a copy still running holds the lock and we may be killed while waiting for it
+        abandoned = sorted(self.processing.keys())
+        for path in abandoned:
+            print("abandoned", path, flush=True)
+
+        if self.lock.acquire(timeout=1.0):
+            try:
+                self.sync_content_recv(locked=True)
+                self.save_uuids()
+            finally:
+                self.lock.release()
+        else:
+            # uuids are saved whenever one is added, so nothing is lost here
+            print("copy still running, skip final flush")
+
+        return abandoned
+
+    def load_uuids(self):
         uuid_path = os.path.join(self.contents_dir, ".uuids.json")
         uuid_backup_path = os.path.join(self.contents_dir, ".uuids.json.backup")
 
@@ -88,35 +152,85 @@ class ContentsHandler(RegexMatchingEventHandler):
                     # fallback
                     self.uuids = {}
 
-        result = self.uuids.get(name, None)
+        return self.uuids
+
+    def save_uuids(self):
+        if self.uuids is None:
+            return
+
+        uuid_path = os.path.join(self.contents_dir, ".uuids.json")
+        uuid_backup_path = os.path.join(self.contents_dir, ".uuids.json.backup")
+        uuid_tmp_path = os.path.join(self.contents_dir, ".uuids.json.tmp")
+
+        try:
+            shutil.copy(uuid_path, uuid_backup_path)
+        except:
+            # TODO: show warning
+            pass
+
+        # write to a temporary file first so that .uuids.json is never half-written
+        try:
+            with open(uuid_tmp_path, mode="w") as f:
+                json.dump(self.uuids, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(uuid_tmp_path, uuid_path)
+        except:
+            # TODO: show warning
+            pass
+
+    def get_uuid(self, name):
+        uuids = self.load_uuids()
+
+        result = uuids.get(name, None)
 
         if result is None:
             # new content
-            while result is None or result in self.uuids.values():
+            while result is None or result in uuids.values():
                 # これが無限ループになる場合それは世界の法則が崩壊したときなので気にせず実装
                 result = str(uuid.uuid4())
 
-            self.uuids[name] = result
+            uuids[name] = result
 
-            try:
-                shutil.copy(uuid_path, uuid_backup_path)
-            except:
-                # TODO: show warning
-                pass
-
-            try:
-                with open(uuid_path, mode="w") as f:
-                    json.dump(self.uuids, f, indent=2)
-            except:
-                # TODO: show warning
-                pass
+            self.save_uuids()
 
         print(result)
 
         return result
 
-    def sync_content_recv(self):
-        with self.lock:
+    def find_published(self, path):
+        # returns the published zip for path if it is already up to date
+        try:
+            with ZipFile(path) as zf:
+                with zf.open("manifest.json", mode="r") as f:
+                    name = json.load(f)["name"]
+            content_id = self.load_uuids().get(name, None)
+            if content_id is None:
+                return None
+
+            final_path = os.path.normpath(os.path.join(self.contents_dir, f"{content_id}.zip"))
+            if os.stat(path).st_size != os.stat(final_path).st_size:
+                return None
+
+            # mtimes are not reliable (cp -p, rsync -a), so compare the CRCs
+            # recorded in the central directories, which does not read the data
+            with ZipFile(path) as src_zf, ZipFile(final_path) as final_zf:
+                src_crcs = sorted((i.filename, i.CRC, i.file_size) for i in src_zf.infolist())
+                final_crcs = sorted((i.filename, i.CRC, i.file_size) for i in final_zf.infolist())
+        except Exception:
+            return None
+
+        if src_crcs == final_crcs:
+            return final_path
+
+        return None
+
+    def sync_content_recv(self, locked: bool = False):
+        if not locked:
+            with self.lock:
+                return self.sync_content_recv(locked=True)
+
+        try:
             while self.conn.poll(0):
                 path = self.conn.recv()
                 try:
@@ -124,6 +238,9 @@ class ContentsHandler(RegexMatchingEventHandler):
                     os.remove(path)
                 except:
                     pass
+        except (EOFError, OSError):
+            # connection closed
+            pass
 
     def sync_content(self, src, dest, modified_time):
         with self.lock:
@@ -131,8 +248,10 @@ class ContentsHandler(RegexMatchingEventHandler):
             if dest is not None:
                 try:
                     content_path = os.path.normpath(os.path.join(self.contents_dir, os.path.basename(dest)))
-                    shutil.copy(dest, content_path)
-                    with ZipFile(content_path) as zf:
+                    published_path = self.find_published(dest)
+                    if published_path is None:
+                        shutil.copy(dest, content_path)
+                    with ZipFile(published_path or content_path) as zf:
                         if zf.getinfo("manifest.json"):
                             with zf.open("manifest.json", mode="r") as f:
                                 meta = json.load(f)
@@ -143,9 +262,16 @@ class ContentsHandler(RegexMatchingEventHandler):
                             return
                     final_path = os.path.normpath(os.path.join(self.contents_dir, f"{meta["id"]}.zip"))
                     print(content_path, final_path)
-                    shutil.move(content_path, final_path)
+                    if published_path is None:
+                        shutil.move(content_path, final_path)
                 except Exception as e:
                     print(e)
+                    # do not leave the unpublished copy behind
+                    if published_path is None:
+                        try:
+                            os.remove(content_path)
+                        except OSError:
+                            pass
                     return
 
                 csrc = ContentSource(path=final_path, orig_path=content_path, content=content)
@@ -164,12 +290,43 @@ class ContentsHandler(RegexMatchingEventHandler):
 
         self.sync_content_recv()
 
-    def check_modify_finished(self, src, dest, timestamp):
+    def target_exists(self) -> bool:
+        # a lost network share looks like an empty target dir
+        if not settings.CHECK_MUST_EXISTS:
+            return True
+        if os.path.exists(os.path.join(settings.TARGET_DIR, ".MUST-EXISTS")):
+            return True
+        print("target dir is lost")
+        return False
+
+    def scan(self, paths) -> Optional[list]:
+        # zips already in target dir on start, synced without waiting for writes to settle
+        if not self.target_exists():
+            return None
+
+        futures = []
+        for path in paths:
+            try:
+                timestamp = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+
+            self.processing[path] = timestamp
+
+            future = self.submit(self.check_modify_finished, None, path, timestamp, 0)
+            if future is not None:
+                futures.append(future)
+
+        return futures
+
+    def check_modify_finished(self, src, dest, timestamp, sleep_dur: Optional[float] = None):
         print("check_modify_finished", src, dest)
+        if sleep_dur is None:
+            sleep_dur = self._sleep_dur
         delay = 0.0
         if dest is not None:
-            for i in range(self._sleep_dur * 10):
-                if self._shutdown:
+            for i in range(int(sleep_dur * 10)):
+                if self._abandon:
                     return
                 time.sleep(0.1)
                 delay += 0.1
@@ -181,6 +338,7 @@ class ContentsHandler(RegexMatchingEventHandler):
             try:
                 current = os.stat(dest).st_mtime
             except FileNotFoundError:
+                self.finish_processing(dest, timestamp)
                 return
 
             print(timestamp, current)
@@ -189,23 +347,29 @@ class ContentsHandler(RegexMatchingEventHandler):
                 # something implicitly changed
                 return
 
-        if not self._shutdown:
+        if not self._abandon:
             tz = datetime.timezone(datetime.timedelta(seconds=time.timezone))
             self.sync_content(src, dest, datetime.datetime.fromtimestamp(timestamp, tz=tz) + datetime.timedelta(seconds=delay))
+            self.finish_processing(dest if dest is not None else src, timestamp)
+
+    def finish_processing(self, path, timestamp):
+        # keep the entry if a newer event for the same path is pending
+        if self.processing.get(path, None) == timestamp:
+            self.processing.pop(path, None)
 
     def dispatch(self, event):
+        if self._shutdown:
+            return
+
         if event.event_type == "nothing":
             self.on_nothing(event)
         else:
-            if not settings.CHECK_MUST_EXISTS or os.path.exists(os.path.join(settings.TARGET_DIR, ".MUST-EXISTS")):
+            if self.target_exists():
                 super().dispatch(event)
-            elif settings.CHECK_MUST_EXISTS:
-                # target dir is lost!
-                print("target dir is lost")
 
     def on_nothing(self, event):
         # called on interval
-        self.executor.submit(self.sync_content_recv)
+        self.submit(self.sync_content_recv)
 
     def on_created(self, event):
         if event.is_directory:
@@ -218,7 +382,7 @@ class ContentsHandler(RegexMatchingEventHandler):
 
         self.processing[event.src_path] = timestamp
 
-        self.executor.submit(self.check_modify_finished, None, event.src_path, timestamp)
+        self.submit(self.check_modify_finished, None, event.src_path, timestamp)
 
     def on_moved(self, event):
         if event.is_directory:
@@ -231,7 +395,7 @@ class ContentsHandler(RegexMatchingEventHandler):
 
         self.processing[event.dest_path] = timestamp
 
-        self.executor.submit(self.check_modify_finished, event.src_path, event.dest_path, timestamp)
+        self.submit(self.check_modify_finished, event.src_path, event.dest_path, timestamp)
 
     def on_deleted(self, event):
         if event.is_directory:
@@ -241,7 +405,7 @@ class ContentsHandler(RegexMatchingEventHandler):
 
         self.processing[event.src_path] = timestamp
 
-        self.executor.submit(self.check_modify_finished, event.src_path, None, timestamp)
+        self.submit(self.check_modify_finished, event.src_path, None, timestamp)
 
     def on_modified(self, event):
         if event.is_directory:
@@ -254,5 +418,5 @@ class ContentsHandler(RegexMatchingEventHandler):
 
         self.processing[event.src_path] = timestamp
 
-        self.executor.submit(self.check_modify_finished, event.src_path, event.src_path, timestamp)
+        self.submit(self.check_modify_finished, event.src_path, event.src_path, timestamp)
 
@@ -0,0 +1,165 @@
+import signal
+import os
+import os.path
+import time
+from multiprocessing import Pipe, Event, Value
+
+from .settings import settings
+
+class Readiness:
+    """
+    子プロセスが準備完了したことと、その時刻を親プロセスに伝える
+    """
+    def __init__(self):
+        self.event = Event()
+        self.at = Value("d", 0.0, lock=False) # time.monotonic() in the child
+
+    def set(self):
+        self.at.value = time.monotonic()
+        self.event.set()
+
+    def is_set(self):
+        return self.event.is_set()
+
+# Each function here is the entry point of a child process.
+# Heavy dependencies are imported inside them so that a spawned child only loads what it uses.
+
+def start_observer(contents_dir: str, conn: Pipe, ready: Readiness):
+    import glob
+    from concurrent.futures import wait
+
+    from .observe import CustomObserver, ContentsHandler, recover_contents_dir
+
+    target_dir = settings.TARGET_DIR
+
+    if target_dir is None:
+        raise RuntimeError("TARGET_DIR not specified")
+
+    for path in recover_contents_dir(contents_dir):
+        print("recovered", path)
+
+    print("start observe for", target_dir)
+    handler = ContentsHandler(contents_dir, conn)
+    handler.set_delay(3)
+    observer = CustomObserver()
+    observer.schedule(handler, target_dir, recursive=False)
+
+    def on_exit(signum, frame):
+        observer.stop()
+
+    signal.signal(signal.SIGTERM, on_exit)
+    signal.signal(signal.SIGINT, on_exit)
+
+    observer.start()
+    try:
+        # not ready while target dir is lost, its listing would be empty
+        futures = None
+        while observer.is_alive():
+            futures = handler.scan(glob.glob(os.path.join(target_dir, "*.zip")))
+            if futures is not None:
+                break
+            observer.join(5)
+
+        # ready once the zips already in target dir are published
+        while observer.is_alive() and futures is not None and wait(futures, timeout=0.5).not_done:
+            pass
+        if observer.is_alive() and futures is not None:
+            ready.set()
+        observer.join()
+        print("obs stop")
+    finally:
+        observer.stop()
+        handler.shutdown(settings.SHUTDOWN_TIMEOUT)
+
+def start_mirror(contents_dir: str, conn: Pipe, ready: Readiness):
+    from .mirror import ContentsMirror
+
+    upstream = settings.UPSTREAM_URL
+
+    print("start mirror of", upstream)
+    mirror = ContentsMirror(contents_dir, conn, upstream, max_workers=settings.MIRROR_WORKERS)
+
+    def on_exit(signum, frame):
+        mirror.stop()
+
+    signal.signal(signal.SIGTERM, on_exit)
+    signal.signal(signal.SIGINT, on_exit)
+
+    try:
+        mirror.run(settings.MIRROR_INTERVAL, ready)
+        print("mirror stop")
+    finally:
+        abandoned = mirror.shutdown(settings.SHUTDOWN_TIMEOUT)
+        for content_id in abandoned:
+            print("abandoned", content_id)
+
+def create_ftpserver(contents_dir: str):
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+
+    # https://pyftpdlib.readthedocs.io/en/latest/tutorial.html#a-base-ftp-server
+
+    # Instantiate a dummy authorizer for managing 'virtual' users
+    authorizer = DummyAuthorizer()
+
+    # Define a read-only anonymous user
+    authorizer.add_anonymous(contents_dir)
+
+    # Instantiate FTP handler class
+    handler = FTPHandler
+    handler.authorizer = authorizer
+
+    # Define a customized banner (string returned when client connects)
+    handler.banner = "pyftpdlib based FTP server ready."
+
+    # Specify a masquerade address and the range of ports to use for
+    # passive connections.  Decomment in case you're behind a NAT.
+    #handler.masquerade_address = '151.25.42.11'
+    #handler.passive_ports = range(60000, 65535)
+
+    # Instantiate FTP server class and listen on all interfaces, port 21
+    address = (settings.API_HOST, settings.FTP_PORT)
+    server = FTPServer(address, handler)
+
+    # set a limit for connections
+    server.max_cons = 256
+    server.max_cons_per_ip = 5
+
+    return server
+
+def start_ftpserver(contents_dir: str, ready: Readiness):
+    from pyftpdlib.handlers import FTPHandler
+
+    server = create_ftpserver(contents_dir)
+    stopping = False
+
+    def on_exit(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, on_exit)
+    signal.signal(signal.SIGINT, on_exit)
+
+    # the socket is listening from here on
+    ready.set()
+
+    while not stopping:
+        server.ioloop.loop(1.0, blocking=False)
+
+    # stop accepting connections but let running transfers finish
+    server.close()
+
+    def transfers():
+        return [h for h in list(server.ioloop.socket_map.values()) if isinstance(h, FTPHandler) and h.data_channel is not None]
+
+    deadline = time.monotonic() + settings.SHUTDOWN_TIMEOUT
+    while transfers() and time.monotonic() < deadline:
+        server.ioloop.loop(0.5, blocking=False)
+
+    abandoned = transfers()
+    if abandoned:
+        print("ftp abandoned", len(abandoned), "transfers")
+
+    server.close_all()
+    print("ftp stop")
@@ -0,0 +1,174 @@
+import asyncio
+import os
+import os.path
+import time
+from multiprocessing import Process, Pipe
+
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+
+from .api import api, content_manager
+from .collect import ContentsCollector
+from .process import Readiness, start_observer, start_mirror, start_ftpserver
+from .settings import settings
+
+__all__ = [
+    "app",
+    "contents_dir"
+]
+
+contents_dir = os.path.normpath(settings.CONTENTS_DIR or os.path.join(__file__, "../../contents"))
+
+started = time.monotonic()
+
+class Component:
+    def __init__(self, name: str, process: Process, ready: Readiness):
+        self.name = name
+        self.process = process
+        self.ready = ready
+
+    @property
+    def ready_in(self):
+        # seconds from startup until the child reported ready
+        if not self.ready.is_set():
+            return None
+        return self.ready.at.value - started
+
+    @property
+    def state(self):
+        if self.ready.is_set():
+            if self.process.is_alive():
+                return "ready"
+        elif self.process.is_alive():
+            return "starting"
+        return "stopped"
+
+    def report(self):
+        return {"state": self.state, "ready_in": self.ready_in}
+
+components = {}
+
+async def watch_ready():
+    # print cold start time of each component
+    waiting = list(components.values())
+    while waiting:
+        for component in [*waiting]:
+            if component.state != "starting":
+                if component.ready_in is not None:
+                    print(component.name, component.state, "in %.2fs" % component.ready_in)
+                else:
+                    print(component.name, component.state)
+                waiting.remove(component)
+        await asyncio.sleep(0.05)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    print("contents dir:", contents_dir)
+
+    # everything unknown in contents dir gets deleted, so it must not hold the source zips
+    if settings.TARGET_DIR is not None:
+        target = os.path.realpath(settings.TARGET_DIR)
+        contents = os.path.realpath(contents_dir)
+        if os.path.commonpath([target, contents]) == contents:
+            raise RuntimeError("CONTENTS_DIR must not be TARGET_DIR or contain it")
+
+    try:
+        os.mkdir(contents_dir)
+    except FileExistsError:
+        pass
+
+    # Pipe for fastapi and observer to communicate with each other
+    (conn_fastapi, conn_observer) = Pipe(duplex=True)
+
+    content_manager.set_connection(conn_fastapi)
+
+    ftp_ready = Readiness()
+    obs_ready = Readiness()
+
+    ftp_process = Process(target=start_ftpserver, args=(contents_dir, ftp_ready))
+    if settings.UPSTREAM_URL is not None:
+        obs_process = Process(target=start_mirror, args=(contents_dir, conn_observer, obs_ready))
+    else:
+        obs_process = Process(target=start_observer, args=(contents_dir, conn_observer, obs_ready))
+
+    # both start in parallel and report readiness on their own
+    ftp_process.start()
+    obs_process.start()
+
+    components["ftp"] = Component("ftp", ftp_process, ftp_ready)
+    obs_component = Component("observer", obs_process, obs_ready)
+    components["observer"] = obs_component
+
+    watch_task = asyncio.create_task(watch_ready())
+
+    collector_task = None
+    if settings.GC_INTERVAL > 0:
+        collector = ContentsCollector(contents_dir, content_manager, quota=settings.GC_QUOTA, ready=lambda: obs_component.state == "ready")
+        collector_task = asyncio.create_task(collector.run(settings.GC_INTERVAL))
+
+    yield
+
+    watch_task.cancel()
+    if collector_task is not None:
+        collector_task.cancel()
+
+    # ask both processes to stop accepting work and drain what is in flight
+    ftp_process.terminate()
+    obs_process.terminate()
+
+    # children get SHUTDOWN_TIMEOUT to drain, give them a little more to report and exit
+    deadline = time.monotonic() + settings.SHUTDOWN_TIMEOUT + 2
+    while obs_process.is_alive() and time.monotonic() < deadline:
+        # keep receiving so the observer never blocks on a full pipe while draining
+        if content_manager.conn is not None and content_manager.conn.poll(0):
+            content_manager.content_sync()
+        await asyncio.sleep(0.1)
+
+    ftp_process.join(max(deadline - time.monotonic(), 0))
+
+    for name, process in (("ftp", ftp_process), ("observer", obs_process)):
+        if process.is_alive():
+            print(name, "did not stop in time, killing")
+            process.kill()
+            process.join()
+
+    conn_fastapi.close()
+    conn_observer.close()
+
+    components.clear()
+
+app = FastAPI(lifespan=lifespan)
+
+app.include_router(api)
+
+origins = [
+    "*"
+]
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=origins,
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+@app.get("/healthz")
+async def healthz():
+    """
+    各プロセスが生きているかを返す
+    """
+    report = {name: component.report() for name, component in components.items()}
+    alive = all(r["state"] != "stopped" for r in report.values())
+    return JSONResponse({"api": {"state": "ready"}, **report}, status_code=200 if alive else 503)
+
+@app.get("/readyz")
+async def readyz():
+    """
+    すべてのプロセスがリクエストを処理できる状態かを返す
+    """
+    report = {name: component.report() for name, component in components.items()}
+    ready = len(report) > 0 and all(r["state"] == "ready" for r in report.values())
+    return JSONResponse({"api": {"state": "ready"}, **report}, status_code=200 if ready else 503)
@@ -1,4 +1,5 @@
 import os
+from typing import Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
@@ -6,10 +7,38 @@ class Settings(BaseSettings):
     API_PORT: int = 8080
     FTP_PORT: int = 2121
 
-    TARGET_DIR: str = None
+    TARGET_DIR: Optional[str] = None
+    # defaults to contents/ next to src/, must be dedicated to this server
+    CONTENTS_DIR: Optional[str] = None
+
+    # run as a mirror of another server instead of watching TARGET_DIR
+    UPSTREAM_URL: Optional[str] = None
+    MIRROR_INTERVAL: float = 5.0
+    MIRROR_WORKERS: int = 2
 
     CHECK_MUST_EXISTS: bool = False
 
+    # seconds to wait for in-flight work on shutdown
+    SHUTDOWN_TIMEOUT: float = 10.0
+
+    # seconds between garbage collections of contents dir, 0 to disable
+    GC_INTERVAL: float = 600.0
+    # max bytes of contents dir before unreferenced zips are evicted early, 0 for no limit
+    GC_QUOTA: int = 0
+
+    # requests per second and burst allowed per client, 0 to disable.
+    # off by default: launchers do not retry on 429 and rooms behind a NAT share one address
+    RATE_LIMIT: float = 0.0
+    RATE_BURST: int = 20
+    # base of the jittered Retry-After on /updates, 0 to disable
+    UPDATES_RETRY_AFTER: float = 5.0
+    # zips served at the same time, 0 for no limit
+    ZIP_CONCURRENCY: int = 8
+    # requests allowed to wait for a slot before getting 503, 0 to let all of them wait
+    ZIP_QUEUE: int = 0
+    # bytes of thumbnails kept in memory
+    THUMBNAIL_CACHE: int = 8 * 1024 * 1024
+
     model_config = SettingsConfigDict(env_file=os.path.normpath(os.path.join(__file__, "../../.env.local")))
 
 settings = Settings()